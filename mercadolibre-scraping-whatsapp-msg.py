@@ -1,9 +1,9 @@
-import requests
+import asyncio
+import gzip
 import sqlite3
-import time
-import schedule
 import logging
-from twilio.rest import Client
+import aiohttp
+import orjson
 
 # --- Configure Logging ---
 logging.basicConfig(
@@ -14,9 +14,22 @@ logging.basicConfig(
 # --- Twilio Credentials (update with your actual values) ---
 account_sid = ''
 auth_token = ''
-twilio_client = Client(account_sid, auth_token)
 twilio_from = ''      # Your Twilio WhatsApp sender number
 twilio_to   = ''      # Your (or your group's) WhatsApp number
+TWILIO_MESSAGES_URL = f"https://api.twilio.com/2010-04-01/Accounts/{account_sid}/Messages.json"
+TWILIO_AUTH = aiohttp.BasicAuth(account_sid, auth_token)
+MAX_MESSAGE_LENGTH = 1600  # Twilio's limit for a single message body
+SEND_CONCURRENCY = 4       # Message parts sent to Twilio at the same time
+
+# --- HTTP settings (a single aiohttp session is shared by all requests) ---
+REQUEST_TIMEOUT = 10                        # seconds, per connect and per socket read
+CONNECTIONS_PER_HOST = 8                    # Concurrent requests per host
+MAX_RETRIES = 3                             # Retries for transient HTTP errors
+RETRY_BACKOFF = 0.5                         # seconds, doubled on each retry
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# --- Interval between job runs ---
+JOB_INTERVAL = 3600  # seconds
 
 # --- List of search terms ---
 lista_busquedas = ['RTX Usado', 'GTX Usado']
@@ -24,216 +37,359 @@ lista_busquedas = ['RTX Usado', 'GTX Usado']
 # --- Database file name ---
 DB_FILE = "offers.db"
 
-def init_db():
+# --- Persistent database connection (opened by init_db, reused across job runs) ---
+CONN = None
+
+# --- SQL statements run on every job (kept identical so sqlite3's statement cache reuses them) ---
+SQL_SELECT_ETAG = "SELECT etag, last_modified, body FROM etags WHERE url = ?"
+SQL_UPSERT_ETAG = "INSERT OR REPLACE INTO etags (url, etag, last_modified, body) VALUES (?, ?, ?, ?)"
+SQL_CLEAR_STAGED = "DELETE FROM current_offers"
+SQL_STAGE = "INSERT OR IGNORE INTO current_offers (id, data) VALUES (?, ?)"
+# RETURNING yields only the rows actually inserted. (The WHERE clause is
+# required by SQLite's upsert syntax for INSERT ... SELECT.)
+SQL_INSERT = '''
+    INSERT INTO offers (id, data)
+    SELECT id, data FROM current_offers WHERE true
+    ON CONFLICT (id) DO NOTHING
+    RETURNING id
+'''
+SQL_DELETE = "DELETE FROM offers WHERE id NOT IN (SELECT id FROM current_offers)"
+
+def _connect():
     """
-    Initialize the SQLite database and create the offers table if it does not exist.
+    Open a connection to the database and apply the per-connection PRAGMAs.
+    Transactions are managed explicitly with BEGIN / commit().
     """
-    logging.debug("Initializing database...")
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
     cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS offers (
+    cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.execute("PRAGMA cache_size = -65536")      # 64 MiB
+    cursor.execute("PRAGMA mmap_size = 268435456")    # 256 MiB
+    cursor.execute("PRAGMA busy_timeout = 60000")     # 60 seconds
+    cursor.execute("PRAGMA cache_spill = OFF")        # Keep dirty pages in memory until commit
+    return conn
+
+def _create_offers_table(cursor, name="offers"):
+    """
+    Create the offers table. Each offer is stored as the full API item in a
+    single JSON text column (query fields with json_extract(data, '$.title')).
+    The TEXT primary key is the only key, so the table is declared WITHOUT ROWID
+    to avoid maintaining a separate rowid B-tree.
+    """
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {name} (
             id TEXT PRIMARY KEY,
-            title TEXT,
-            price REAL,
-            permalink TEXT,
+            data TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+
+def init_db():
+    """
+    Open the persistent database connection, create the offers and etags tables
+    if they do not exist, and create the temporary table used to stage each run.
+    """
+    global CONN
+    logging.debug("Initializing database...")
+    CONN = _connect()
+    cursor = CONN.cursor()
+    # WAL mode is persistent in the database file, so it only needs to be set once.
+    cursor.execute("PRAGMA journal_mode = WAL")
+    _create_offers_table(cursor)
+    # One-time migration of databases created with the old one-column-per-field layout
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(offers)")}
+    if "data" not in columns:
+        logging.info("Rebuilding offers table with a JSON data column...")
+        cursor.execute("BEGIN")
+        _create_offers_table(cursor, "offers_new")
+        cursor.execute('''
+            INSERT INTO offers_new (id, data, timestamp)
+            SELECT id,
+                   json_object('id', id, 'title', title, 'price', price, 'permalink', permalink),
+                   timestamp
+            FROM offers
+            WHERE id IS NOT NULL
+        ''')
+        cursor.execute("DROP TABLE offers")
+        cursor.execute("ALTER TABLE offers_new RENAME TO offers")
+        CONN.commit()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_ts ON offers (timestamp)")
+    # Cached API pages (gzipped JSON) keyed by URL, for conditional GETs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS etags (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            body BLOB
         )
     ''')
-    conn.commit()
-    conn.close()
+    # Staging table for the offers fetched in a run (lives as long as the connection)
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS current_offers (
+            id TEXT PRIMARY KEY,
+            data TEXT
+        ) WITHOUT ROWID
+    ''')
     logging.debug("Database initialized.")
 
-def fetch_offers(query):
+async def fetch_page(session, query, offset, cache_updates):
+    """
+    Fetch a single page of search results for the given query and offset,
+    retrying transient HTTP errors, connection errors and timeouts with
+    exponential backoff.
+    The page's cached ETag / Last-Modified are sent as If-None-Match /
+    If-Modified-Since, and on 304 the cached body is reused. Fresh cache rows are
+    appended to cache_updates for the caller to write in one transaction.
+    Returns the decoded response, or None if the request failed.
+    """
+    url = f"https://api.mercadolibre.com/sites/MLU/search?q={query}&offset={offset}"
+    logging.debug("Fetching offers for query '%s' with offset %d: %s", query, offset, url)
+    try:
+        cached = CONN.execute(SQL_SELECT_ETAG, (url,)).fetchone()
+        headers = {}
+        if cached and cached[0]:
+            headers["If-None-Match"] = cached[0]
+        if cached and cached[1]:
+            headers["If-Modified-Since"] = cached[1]
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                        status = response.status
+                        etag = response.headers.get("ETag")
+                        last_modified = response.headers.get("Last-Modified")
+                        body = await response.read()
+                        break
+                    reason = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                reason = f"{type(e).__name__} {e}".strip()
+            delay = RETRY_BACKOFF * 2 ** attempt
+            logging.warning("Query '%s', offset %d: %s, retrying in %.1fs.",
+                            query, offset, reason, delay)
+            await asyncio.sleep(delay)
+
+        if status == 304 and cached:
+            logging.debug("Query '%s', offset %d: Not modified, using cached page.", query, offset)
+            body = gzip.decompress(cached[2])
+        elif status == 200 and (etag or last_modified):
+            cache_updates.append((url, etag, last_modified, gzip.compress(body)))
+        data = orjson.loads(body)
+        logging.debug("Query '%s', offset %d: Fetched %d offers.",
+                      query, offset, len(data.get("results", [])))
+        return data
+    except Exception as e:
+        logging.error("Error fetching offers for query '%s' at offset %d: %s", query, offset, e)
+        return None
+
+def save_page_cache(cache_updates):
     """
-    Query the MercadoLibre API for the given search term using pagination
-    and return a list of unique offers.
+    Write the fetched pages' cache rows in a single transaction.
     """
+    if not cache_updates:
+        return
+    cursor = CONN.cursor()
+    cursor.execute("BEGIN")
+    try:
+        cursor.executemany(SQL_UPSERT_ETAG, cache_updates)
+    except Exception:
+        CONN.rollback()
+        raise
+    CONN.commit()
+    logging.debug("Page cache updated: %d pages stored.", len(cache_updates))
+
+async def fetch_offers(session, query):
+    """
+    Query the MercadoLibre API for the given search term and return a dict of
+    unique offers keyed by offer ID. The first page reports the total number of
+    results, so only the pages that actually exist are then fetched concurrently.
+    """
+    cache_updates = []
+    first_page = await fetch_page(session, query, 0, cache_updates)
+    if first_page is None:
+        return {}
+    # Without a usable paging total, fall back to the results on the first page itself
+    total = (first_page.get("paging") or {}).get("total")
+    if not isinstance(total, int):
+        total = len(first_page.get("results") or [])
+    # Offsets in steps of 50, up to the last result (the API caps the offset at 1000).
+    last_offset = min(1000, total - 1)
+    offsets = range(0, last_offset + 1, 50)
+    logging.debug("Query '%s': %d results reported, fetching %d pages.", query, total, len(offsets))
+    pages = [first_page]
+    pages += await asyncio.gather(*(fetch_page(session, query, offset, cache_updates)
+                                    for offset in offsets[1:]))
+    save_page_cache(cache_updates)
+
     all_offers = {}
-    # Iterate over offsets from 0 to 1000 (inclusive) in steps of 50.
-    for offset in range(0, 1001, 50):
-        url = f"https://api.mercadolibre.com/sites/MLU/search?q={query}&offset={offset}"
-        logging.debug("Fetching offers for query '%s' with offset %d: %s", query, offset, url)
-        try:
-            response = requests.get(url)
-            data = response.json()
-            results = data.get("results", [])
-            logging.debug("Query '%s', offset %d: Fetched %d offers.", query, offset, len(results))
-            if not results:
-                logging.debug("No offers returned for query '%s' at offset %d. Ending pagination.", query, offset)
-                break
-            for item in results:
-                item_id = item.get("id")
-                # Deduplicate: add if not already present.
-                if item_id not in all_offers:
-                    all_offers[item_id] = item
-            # If fewer than 50 items were returned, likely there are no further pages.
-            if len(results) < 50:
-                logging.debug("Fewer than 50 results returned for query '%s'. Ending pagination.", query)
-                break
-        except Exception as e:
-            logging.error("Error fetching offers for query '%s' at offset %d: %s", query, offset, e)
+    # Walk the pages in order and stop where sequential pagination would have stopped.
+    for offset, data in zip(offsets, pages):
+        if data is None:
+            break
+        results = data.get("results", [])
+        if not results:
+            logging.debug("No offers returned for query '%s' at offset %d. Ending pagination.", query, offset)
+            break
+        for item in results:
+            item_id = item.get("id")
+            # Deduplicate: add if not already present.
+            if item_id not in all_offers:
+                all_offers[item_id] = item
+        # If fewer than 50 items were returned, likely there are no further pages.
+        if len(results) < 50:
+            logging.debug("Fewer than 50 results returned for query '%s'. Ending pagination.", query)
             break
 
     logging.info("Query '%s': Total unique offers found: %d", query, len(all_offers))
-    return list(all_offers.values())
+    return all_offers
 
-def get_existing_offer_ids():
+def sync_offers_with_db(current_offers):
     """
-    Retrieve a set of offer IDs that are currently stored in the database.
+    Stage the current offers in a temporary table and let SQLite compute the diff
+    against the stored offers in a single transaction: new offers are inserted and
+    offers that have disappeared are deleted.
+    Returns a tuple (new_offer_ids, removed_count).
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM offers")
-    rows = cursor.fetchall()
-    conn.close()
-    existing_ids = set(row[0] for row in rows)
-    logging.debug("Existing offer IDs in DB: %s", existing_ids)
-    return existing_ids
+    cursor = CONN.cursor()
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute(SQL_CLEAR_STAGED)
+        cursor.executemany(SQL_STAGE, [(item.get("id"), orjson.dumps(item).decode()) for item in current_offers])
 
-def add_offer_to_db(item):
-    """
-    Insert a new offer into the database.
-    """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO offers (id, title, price, permalink)
-        VALUES (?, ?, ?, ?)
-    ''', (item.get("id"), item.get("title"), item.get("price"), item.get("permalink")))
-    conn.commit()
-    conn.close()
-    logging.debug("Offer %s added to database.", item.get("id"))
+        # New offers: present in the API results but not yet in the database
+        cursor.execute(SQL_INSERT)
+        new_offer_ids = [row[0] for row in cursor.fetchall()]
+
+        # Disappeared offers: in the database but not in the current API results
+        cursor.execute(SQL_DELETE)
+        removed_count = cursor.rowcount
+    except Exception:
+        CONN.rollback()
+        raise
+    CONN.commit()
+    logging.debug("Database updated: %d offers added, %d removed.", len(new_offer_ids), removed_count)
+    return new_offer_ids, removed_count
 
-def remove_offer_from_db(offer_id):
+async def send_message(session, body):
     """
-    Delete an offer from the database that is no longer available.
+    Send a single WhatsApp message through the Twilio REST API.
+    Returns the message SID, or raises an exception with Twilio's error message.
     """
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM offers WHERE id = ?", (offer_id,))
-    conn.commit()
-    conn.close()
-    logging.debug("Offer %s removed from database.", offer_id)
+    async with session.post(
+        TWILIO_MESSAGES_URL,
+        data={"From": twilio_from, "To": twilio_to, "Body": body},
+        auth=TWILIO_AUTH
+    ) as response:
+        payload = await response.read()
+        if response.status >= 400:
+            # Error bodies are usually JSON, but proxies and 5xx pages may not be
+            try:
+                error = orjson.loads(payload)
+                detail = f"{error.get('code')}: {error.get('message')}"
+            except orjson.JSONDecodeError:
+                detail = payload[:200].decode(errors="replace")
+            raise RuntimeError(f"Twilio error (HTTP {response.status}) {detail}")
+        return orjson.loads(payload).get("sid")
 
-def send_notification(new_offers):
+async def send_notification(session, new_offers):
     """
     Send a WhatsApp notification via Twilio listing all new offers.
-    If the full message exceeds 1600 characters, split the message into parts
-    (ensuring that an offer is not split across messages) and send them separately.
+    Messages are limited to 1600 characters, so the offers are split up front into
+    as many messages as needed (an offer is never split across messages).
     """
     if not new_offers:
         logging.debug("No new offers to notify.")
         return
 
-    # Build the complete message text
-    message_text = "New 'Usado' offers found:\n"
-    for item in new_offers:
-        title = item.get("title")
-        price = item.get("price")
-        link = item.get("permalink")
-        message_text += f"- {title} for ${price}\n{link}\n\n"
+    header = "New 'Usado' offers found:\n"
+    offer_texts = [f"- {item.get('title')} for ${item.get('price')}\n{item.get('permalink')}\n\n"
+                   for item in new_offers]
 
-    try:
-        # Try sending the message as a whole
-        message = twilio_client.messages.create(
-            from_=twilio_from,
-            body=message_text,
-            to=twilio_to
-        )
-        logging.info("Notification sent. SID: %s", message.sid)
-    except Exception as e:
-        error_message = str(e)
-        # Check if the error is due to exceeding the 1600-character limit
-        if "1600" in error_message:
-            logging.warning("Message exceeds 1600 character limit. Splitting into multiple messages.")
-            header = "New 'Usado' offers found:\n"
-            messages = []
-            current_message = header
-            for item in new_offers:
-                offer_text = f"- {item.get('title')} for ${item.get('price')}\n{item.get('permalink')}\n\n"
-                # If adding this offer would exceed the limit, start a new message
-                if len(current_message) + len(offer_text) > 1600:
-                    messages.append(current_message)
-                    current_message = offer_text
-                else:
-                    current_message += offer_text
-            # Append any remaining text as the last message part
-            if current_message:
-                messages.append(current_message)
-
-            # Send each message part separately
-            for idx, msg in enumerate(messages, start=1):
-                try:
-                    part_message = twilio_client.messages.create(
-                        from_=twilio_from,
-                        body=msg,
-                        to=twilio_to
-                    )
-                    logging.info("Notification part %d sent. SID: %s", idx, part_message.sid)
-                except Exception as e2:
-                    logging.error("Error sending notification part %d: %s", idx, e2)
+    messages = []
+    current_parts = [header]
+    current_length = len(header)
+    for offer_text in offer_texts:
+        # If adding this offer would exceed the limit, start a new message
+        if current_length + len(offer_text) > MAX_MESSAGE_LENGTH:
+            messages.append("".join(current_parts))
+            current_parts = [offer_text]
+            current_length = len(offer_text)
         else:
-            logging.error("Error sending notification: %s", e)
+            current_parts.append(offer_text)
+            current_length += len(offer_text)
+    # Append any remaining text as the last message part
+    messages.append("".join(current_parts))
+    if len(messages) > 1:
+        logging.info("Notification exceeds %d characters. Sending it as %d messages.",
+                     MAX_MESSAGE_LENGTH, len(messages))
+
+    # Send the parts concurrently, bounded to stay within Twilio's rate limit
+    semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+
+    async def send_part(idx, msg):
+        async with semaphore:
+            try:
+                sid = await send_message(session, msg)
+                logging.info("Notification part %d/%d sent. SID: %s", idx, len(messages), sid)
+            except Exception as e:
+                logging.error("Error sending notification part %d/%d: %s", idx, len(messages), e)
 
-def job():
+    await asyncio.gather(*(send_part(idx, msg) for idx, msg in enumerate(messages, start=1)))
+
+async def job(session):
     """
-    Main job function that iterates over all search terms, fetches offers,
+    Main job function that fetches offers for all search terms concurrently,
     updates the database, and sends notifications for new offers.
     """
     logging.info("Job started...")
     all_current_offers = {}
-    # Loop through each search term in the list and aggregate results.
-    for query in lista_busquedas:
-        offers = fetch_offers(query)
+    results = await asyncio.gather(*(fetch_offers(session, query) for query in lista_busquedas))
+    # Aggregate each search term's results (already keyed by ID, so this also deduplicates).
+    for query, offers in zip(lista_busquedas, results):
         logging.info("Query '%s' returned %d offers.", query, len(offers))
-        for item in offers:
-            all_current_offers[item.get("id")] = item  # Deduplicate offers by ID
+        all_current_offers.update(offers)
 
-    current_offers = list(all_current_offers.values())
-    if not current_offers:
+    if not all_current_offers:
         logging.warning("No offers fetched for any query. Skipping this run.")
         return
 
-    existing_offer_ids = get_existing_offer_ids()
-    current_offer_ids = set(item.get("id") for item in current_offers)
-    logging.debug("Current API offer IDs: %s", current_offer_ids)
-    
-    # Identify new offers (present in API results but not in the database)
-    new_offers = [item for item in current_offers if item.get("id") not in existing_offer_ids]
+    new_offer_ids, removed_count = sync_offers_with_db(all_current_offers.values())
+    # Keep the API's (relevance) order rather than SQLite's primary-key order
+    new_ids = set(new_offer_ids)
+    new_offers = [item for item in all_current_offers.values() if item.get("id") in new_ids]
     logging.info("%d new offers found.", len(new_offers))
+    logging.info("%d offers have disappeared.", removed_count)
 
-    for item in new_offers:
-        add_offer_to_db(item)
-    
-    # Identify offers that have disappeared (in DB but not in current API response)
-    disappeared_offer_ids = existing_offer_ids - current_offer_ids
-    logging.info("%d offers have disappeared.", len(disappeared_offer_ids))
-    for offer_id in disappeared_offer_ids:
-        remove_offer_from_db(offer_id)
-    
     if new_offers:
-        send_notification(new_offers)
+        await send_notification(session, new_offers)
     else:
         logging.info("No new offers to send notification for.")
-    
+
+    # Refresh the query planner statistics after this run's bulk changes
+    CONN.execute("ANALYZE")
     logging.info("Job finished.")
 
-def main():
+async def main():
     """
-    Initialize the database, run the job once, and schedule it to run every hour.
+    Initialize the database, run the job once, and then run it again every hour.
     """
     logging.info("Starting system...")
     init_db()  # Set up the SQLite database if it doesn't exist
-    job()      # Run immediately at startup
-
-    # Schedule the job to run every hour
-    schedule.every(1).hours.do(job)
-    logging.info("Scheduler started. The job will run every hour.")
 
-    while True:
-        schedule.run_pending()
-        time.sleep(60)  # Wait one minute between checks
+    connector = aiohttp.TCPConnector(limit_per_host=CONNECTIONS_PER_HOST)
+    # Per-socket limits only: a total timeout would also count the time a request
+    # waits for a free pooled connection behind limit_per_host.
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        logging.info("Scheduler started. The job will run every hour.")
+        loop = asyncio.get_running_loop()
+        while True:
+            # Schedule against the start of the run so the job's duration doesn't drift the interval
+            next_run = loop.time() + JOB_INTERVAL
+            await job(session)
+            await asyncio.sleep(max(0, next_run - loop.time()))
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())